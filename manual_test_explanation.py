@@ -4,17 +4,20 @@ Manual test script for WrenAI stream_explanation endpoint
 Simple script to test individual steps manually
 """
 
+import argparse
 import requests
 import json
 import os
+from sse_utils import format_response, iter_sse_data, loads
 
-def test_step_by_step():
+# Set SSE_DEBUG=1 (or pass --debug) to print every SSE payload and parsed frame
+DEBUG = os.getenv("SSE_DEBUG") == "1"
+
+DEFAULT_QUESTION = "tell me about the all fields in the table"
+
+def test_step_by_step(base_url: str, question: str = DEFAULT_QUESTION, param_name: str = "explanationQueryId"):
     """Test the stream explanation flow step by step"""
     
-    # Configuration
-    base_url = os.getenv("WREN_UI_URL", "http://localhost:3000")
-    question = "tell me about the all fields in the table"
-    
     print("🧪 Manual WrenAI Stream Explanation Test")
     print("=" * 50)
     print(f"🌐 Base URL: {base_url}")
@@ -27,104 +30,122 @@ def test_step_by_step():
         "User-Agent": "WrenAI-Manual-Test/1.0",
     }
     
+    # Both steps share one keep-alive connection
+    session = requests.Session()
+    session.headers.update(headers)
+    
     # Step 1: Call generate_sql
     print("🔍 Step 1: Calling /api/v1/generate_sql")
     print("-" * 30)
     
     try:
-        response = requests.post(
+        response = session.post(
             f"{base_url}/api/v1/generate_sql",
             json={"question": question},
-            headers=headers,
             timeout=30
         )
-        
         # Don't raise for status - 400 might be a valid NON_SQL_QUERY response
         data = response.json()
-        print("✅ Response:")
-        print(json.dumps(data, indent=2))
+    except requests.exceptions.RequestException as e:
+        report_request_error(e)
+        return False
+    
+    print("✅ Response:")
+    print(format_response(data))
+    
+    if data.get("code") != "NON_SQL_QUERY":
+        print("ℹ️  Response was not NON_SQL_QUERY")
+        return False
+    
+    explanation_query_id = data.get("explanationQueryId")
+    if not explanation_query_id:
+        print("❌ No explanationQueryId found in response")
+        return False
+    
+    print(f"\n🎯 Found explanationQueryId: {explanation_query_id}")
+    
+    # Step 2: Call stream_explanation
+    print("\n🌊 Step 2: Calling /api/v1/stream_explanation")
+    print("-" * 30)
+    
+    sse_headers = {**headers, "Accept": "text/event-stream", "Accept-Encoding": "identity"}
+    
+    try:
+        response = session.get(
+            f"{base_url}/api/v1/stream_explanation",
+            params={param_name: explanation_query_id},
+            headers=sse_headers,
+            stream=True,
+            timeout=60
+        )
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        report_request_error(e)
+        return False
+    
+    print("✅ Stream started, receiving data...")
+    print("=" * 50)
+    
+    chunks = []
+    message_count = 0
+    
+    # A network error mid-stream fails the test; a bad frame only skips itself
+    try:
+        for data_bytes in iter_sse_data(response):
+            if DEBUG:
+                print(f"🔍 Data string: '{data_bytes.decode('utf-8', 'replace')}'")
+            try:
+                data = loads(data_bytes)
+            except json.JSONDecodeError as e:
+                print(f"\n⚠️  JSON Error: {e}")
+                print(f"Raw data: {data_bytes.decode('utf-8', 'replace')}")
+                continue
+            if DEBUG:
+                print(f"🔍 Parsed JSON: {data}")
+            if not isinstance(data, dict):
+                print(f"\n⚠️  Unexpected frame: {data}")
+                continue
         
-        if data.get("code") == "NON_SQL_QUERY":
-            explanation_query_id = data.get("explanationQueryId")
-            if explanation_query_id:
-                print(f"\n🎯 Found explanationQueryId: {explanation_query_id}")
-                
-                # Step 2: Call stream_explanation
-                print("\n🌊 Step 2: Calling /api/v1/stream_explanation")
-                print("-" * 30)
-                
-                sse_headers = {**headers, "Accept": "text/event-stream"}
-                
-                response = requests.get(
-                    f"{base_url}/api/v1/stream_explanation",
-                    params={"queryId": explanation_query_id},
-                    headers=sse_headers,
-                    stream=True,
-                    timeout=60
-                )
-                response.raise_for_status()
-                
-                print("✅ Stream started, receiving data...")
-                print("=" * 50)
-                
-                full_text = ""
-                message_count = 0
-                
-                for line in response.iter_lines(decode_unicode=True):
-                    print(f"🔍 Raw line: '{line}'")  # Debug: show all lines
-                    if not line:
-                        continue
-                    
-                    if line.startswith("data:"):
-                        data_str = line[len("data:"):].strip()
-                        print(f"🔍 Data string: '{data_str}'")  # Debug: show data string
-                        if data_str:
-                            try:
-                                data = json.loads(data_str)
-                                print(f"🔍 Parsed JSON: {data}")  # Debug: show parsed JSON
-                                
-                                if data.get("done"):
-                                    print("\n" + "=" * 50)
-                                    print("✅ Stream completed!")
-                                    print(f"📊 Messages received: {message_count}")
-                                    print(f"📝 Full explanation:\n{full_text}")
-                                    return True
-                                
-                                if "message" in data:
-                                    message = data["message"]
-                                    full_text += message
-                                    message_count += 1
-                                    print(f"📝 {message_count}: {message}", end="", flush=True)
-                                    
-                            except json.JSONDecodeError as e:
-                                print(f"\n⚠️  JSON Error: {e}")
-                                print(f"Raw data: {data_str}")
-                            except Exception as e:
-                                print(f"\n⚠️  Error: {e}")
-                    else:
-                        print(f"🔍 Non-data line: '{line}'")  # Debug: show non-data lines
-                
-                print(f"\n\n📝 Final text: {full_text}")
+            if data.get("done"):
+                full_text = "".join(chunks)
+                print("\n" + "=" * 50)
+                print("✅ Stream completed!")
+                print(f"📊 Messages received: {message_count}")
+                print(f"📝 Full explanation:\n{full_text}")
                 return True
-            else:
-                print("❌ No explanationQueryId found in response")
-                return False
-        else:
-            print("ℹ️  Response was not NON_SQL_QUERY")
-            return False
-            
+        
+            if "message" in data:
+                message = data["message"]
+                chunks.append(message)
+                message_count += 1
+                # Flush every 16 messages instead of on every token
+                print(f"📝 {message_count}: {message}", end="", flush=message_count % 16 == 0)
     except requests.exceptions.RequestException as e:
-        print(f"❌ Request error: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            print(f"Response status: {e.response.status_code}")
-            print(f"Response text: {e.response.text}")
-        return False
-    except Exception as e:
-        print(f"❌ Unexpected error: {e}")
+        report_request_error(e)
         return False
+    
+    full_text = "".join(chunks)
+    print(f"\n\n📝 Final text: {full_text}")
+    return True
+
+def report_request_error(e: requests.exceptions.RequestException):
+    """Print a failed request and the server's response, if any"""
+    print(f"❌ Request error: {e}")
+    if e.response is not None:
+        print(f"Response status: {e.response.status_code}")
+        print(f"Response text: {e.response.text}")
 
 if __name__ == "__main__":
-    success = test_step_by_step()
+    parser = argparse.ArgumentParser(description="Manually test the WrenAI stream_explanation flow")
+    parser.add_argument("--question", default=DEFAULT_QUESTION, help="Question sent to generate_sql")
+    parser.add_argument("--base-url", default=os.getenv("WREN_UI_URL", "http://localhost:3000"), help="Wren-UI base URL")
+    parser.add_argument("--param-name", default="explanationQueryId", help="Query parameter that carries the explanation ID")
+    parser.add_argument("--debug", action="store_true", help="Print every SSE payload and parsed frame")
+    args = parser.parse_args()
+    if args.debug:
+        DEBUG = True
+    
+    success = test_step_by_step(args.base_url, args.question, args.param_name)
     if success:
         print("\n🎉 Test completed successfully!")
     else:
@@ -0,0 +1,86 @@
+"""
+Shared Server-Sent Events helpers for the WrenAI test scripts
+Reads the raw response body with read1 instead of requests' iter_lines
+"""
+
+import json
+import re
+import sys
+from typing import Iterator
+
+import requests
+from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError, SSLError
+
+# orjson parses small SSE frames several times faster; fall back to the stdlib
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    orjson = None
+    loads = json.loads
+
+# Size of each read from the response body
+CHUNK_SIZE = 65536
+
+# SSE field prefix for event payloads, matched against raw bytes
+DATA_PREFIX = b"data:"
+
+# One C-level sweep pulls every data: payload out of a block of complete events
+SSE_DATA_RE = re.compile(rb"^" + re.escape(DATA_PREFIX) + rb"[ \t]*([^\r\n]*)", re.MULTILINE)
+
+
+def iter_raw_chunks(response: requests.Response, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Yield whatever bytes the socket has ready, skipping requests' iter_content layers"""
+    raw = response.raw
+    read1 = getattr(raw, "read1", None)
+    if read1 is None:
+        # urllib3 < 2 has no read1
+        yield from response.iter_content(chunk_size=chunk_size)
+        return
+    # A no-op with Accept-Encoding: identity, but keeps compressed streams readable
+    raw.decode_content = True
+    # Same error translation as iter_content, so callers' RequestException handlers still apply
+    try:
+        while True:
+            chunk = read1(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    except ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except DecodeError as e:
+        raise requests.exceptions.ContentDecodingError(e)
+    except ReadTimeoutError as e:
+        raise requests.exceptions.ConnectionError(e)
+    except SSLError as e:
+        raise requests.exceptions.SSLError(e)
+
+
+def iter_sse_data(response: requests.Response, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Yield the raw payload of every non-empty data: line in the response"""
+    buf = b""
+    for chunk in iter_raw_chunks(response, chunk_size):
+        buf += chunk
+        # Only scan up to the last complete line (so LF and CRLF framing both work); keep the partial tail for the next chunk
+        last = buf.rfind(b"\n")
+        if last == -1:
+            continue
+        for match in SSE_DATA_RE.finditer(buf, 0, last):
+            if match.group(1):
+                yield match.group(1)
+        buf = buf[last + 1:]
+
+    # Last line of a stream that ended without a newline
+    for match in SSE_DATA_RE.finditer(buf):
+        if match.group(1):
+            yield match.group(1)
+
+
+def format_response(data) -> str:
+    """Pretty-print a JSON response on a terminal, or summarize its keys when piped"""
+    if not sys.stdout.isatty():
+        keys = ", ".join(data) if isinstance(data, dict) else type(data).__name__
+        return f"(keys: {keys})"
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2).decode("utf-8")
+    return json.dumps(data, indent=2, ensure_ascii=False)
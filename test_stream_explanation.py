@@ -5,13 +5,16 @@ Tests the complete flow: generate_sql -> get explanationQueryId -> stream_explan
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+import hashlib
 import json
-import time
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
+from sse_utils import format_response, iter_sse_data, loads
 
 class WrenAITester:
-    def __init__(self, base_url: str = "http://wren-ui:3000"):
+    def __init__(self, base_url: str = "http://wren-ui:3000", cache_path: Optional[str] = None, pool_size: int = 16):
         self.base_url = base_url
         self.headers = {
             "Accept": "application/json; charset=utf-8",
@@ -19,20 +22,56 @@ class WrenAITester:
             "User-Agent": "WrenAI-Test-Script/1.0",
             "Connection": "keep-alive",
         }
+        # One pooled session so generate_sql and stream_explanation share a keep-alive connection;
+        # pool_size should cover the number of flows run concurrently so none wait on a socket
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Prepared once; each question only swaps in a new body
+        self.generate_sql_request = self.session.prepare_request(
+            requests.Request("POST", f"{self.base_url}/api/v1/generate_sql")
+        )
+        # session.send skips the environment lookup session.post does, so pick up
+        # proxies and REQUESTS_CA_BUNDLE / verify settings here
+        self.generate_sql_settings = self.session.merge_environment_settings(
+            self.generate_sql_request.url, {}, None, None, None
+        )
+        # Optional on-disk cache of {question hash: explanation} so repeat runs skip the server
+        self.cache_path = cache_path
+        self.cache = {}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, encoding="utf-8") as f:
+                self.cache = json.load(f)
+
+    @staticmethod
+    def cache_key(question: str) -> str:
+        """Hash of the question with case and whitespace normalized"""
+        normalized = " ".join(question.lower().split())
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def save_cache(self):
+        """Write the explanation cache back to disk"""
+        if not self.cache_path:
+            return
+        with open(self.cache_path, "w", encoding="utf-8") as f:
+            json.dump(self.cache, f, ensure_ascii=False, indent=2)
 
     def test_generate_sql(self, question: str) -> Optional[str]:
         """Test the generate_sql endpoint and return explanationQueryId if NON_SQL_QUERY"""
         print(f"🔍 Testing generate_sql with question: '{question}'")
         
-        url = f"{self.base_url}/api/v1/generate_sql"
-        payload = {"question": question}
+        request = self.generate_sql_request.copy()
+        request.body = json.dumps({"question": question}).encode("utf-8")
+        request.headers["Content-Length"] = str(len(request.body))
         
         try:
-            response = requests.post(url, json=payload, headers=self.headers, timeout=30)
+            response = self.session.send(request, timeout=30, **self.generate_sql_settings)
             response.raise_for_status()
             
             data = response.json()
-            print(f"✅ Response received: {json.dumps(data, indent=2)}")
+            print(f"✅ Response received: {format_response(data)}")
             
             if data.get("code") == "NON_SQL_QUERY":
                 explanation_query_id = data.get("explanationQueryId")
@@ -50,7 +89,7 @@ class WrenAITester:
             print(f"❌ Error calling generate_sql: {e}")
             return None
 
-    def test_stream_explanation(self, explanation_query_id: str) -> bool:
+    def test_stream_explanation(self, explanation_query_id: str, cache_key: Optional[str] = None) -> bool:
         """Test the stream_explanation endpoint"""
         print(f"🌊 Testing stream_explanation with ID: {explanation_query_id}")
         
@@ -58,64 +97,73 @@ class WrenAITester:
         params = {"explanationQueryId": explanation_query_id}
         
         # Update headers for SSE
-        sse_headers = {**self.headers, "Accept": "text/event-stream"}
+        sse_headers = {**self.headers, "Accept": "text/event-stream", "Accept-Encoding": "identity"}
         
         try:
-            response = requests.get(url, params=params, headers=sse_headers, stream=True, timeout=60)
+            response = self.session.get(url, params=params, headers=sse_headers, stream=True, timeout=60)
             response.raise_for_status()
-            
-            print("📡 Starting to receive stream...")
-            print("=" * 50)
-            
-            full_explanation = ""
-            message_count = 0
-            
-            for line in response.iter_lines(decode_unicode=True):
-                if not line:
+        except requests.exceptions.RequestException as e:
+            print(f"❌ Error calling stream_explanation: {e}")
+            return False
+        
+        print("📡 Starting to receive stream...")
+        print("=" * 50)
+        
+        chunks = []
+        message_count = 0
+        
+        # Each item is the payload of one SSE "data: {...json...}" line
+        try:
+            for data_bytes in iter_sse_data(response):
+                try:
+                    data = loads(data_bytes)
+                except json.JSONDecodeError as e:
+                    print(f"⚠️  Failed to parse JSON: {data_bytes.decode('utf-8', 'replace')} - Error: {e}")
+                    continue
+                if not isinstance(data, dict):
+                    print(f"⚠️  Unexpected frame: {data}")
                     continue
-                    
-                # Parse SSE format: "data: {...json...}"
-                if line.startswith("data:"):
-                    data_str = line[len("data:"):].strip()
-                    if data_str:
-                        try:
-                            data = json.loads(data_str)
-                            
-                            # Check if stream is done
-                            if data.get("done"):
-                                print("\n" + "=" * 50)
-                                print("✅ Stream completed!")
-                                print(f"📊 Total messages received: {message_count}")
-                                print(f"📝 Full explanation length: {len(full_explanation)} characters")
-                                return True
-                            
-                            # Handle message chunks
-                            if "message" in data:
-                                message = data["message"]
-                                full_explanation += message
-                                message_count += 1
-                                print(f"📝 Message {message_count}: '{message}'")
-                                
-                        except json.JSONDecodeError as e:
-                            print(f"⚠️  Failed to parse JSON: {data_str} - Error: {e}")
-                        except Exception as e:
-                            print(f"⚠️  Unexpected error processing line: {e}")
             
-            print("\n" + "=" * 50)
-            print("✅ Stream completed (no 'done' marker received)")
-            print(f"📊 Total messages received: {message_count}")
-            print(f"📝 Full explanation: {full_explanation}")
-            return True
+                # Check if stream is done
+                if data.get("done"):
+                    full_explanation = "".join(chunks)
+                    if cache_key and self.cache_path:
+                        self.cache[cache_key] = full_explanation
+                    print("\n" + "=" * 50)
+                    print("✅ Stream completed!")
+                    print(f"📊 Total messages received: {message_count}")
+                    print(f"📝 Full explanation length: {len(full_explanation)} characters")
+                    # Nothing after "done" is read; close the stream so its pool slot is freed
+                    response.close()
+                    return True
             
+                # Handle message chunks
+                if "message" in data:
+                    message = data["message"]
+                    chunks.append(message)
+                    message_count += 1
+                    print(f"📝 Message {message_count}: '{message}'")
         except requests.exceptions.RequestException as e:
             print(f"❌ Error calling stream_explanation: {e}")
             return False
+        
+        print("\n" + "=" * 50)
+        print("✅ Stream completed (no 'done' marker received)")
+        print(f"📊 Total messages received: {message_count}")
+        full_explanation = "".join(chunks)
+        print(f"📝 Full explanation: {full_explanation}")
+        return True
 
     def test_complete_flow(self, question: str) -> bool:
         """Test the complete flow: generate_sql -> stream_explanation"""
         print("🚀 Starting complete WrenAI explanation flow test")
         print("=" * 60)
         
+        key = self.cache_key(question)
+        if self.cache_path and key in self.cache:
+            print(f"💾 Cached explanation found for '{question}', skipping the server")
+            return True
+        
         # Step 1: Get explanationQueryId
         explanation_query_id = self.test_generate_sql(question)
         if not explanation_query_id:
@@ -125,7 +173,7 @@ class WrenAITester:
         print("\n" + "=" * 60)
         
         # Step 2: Stream explanation
-        success = self.test_stream_explanation(explanation_query_id)
+        success = self.test_stream_explanation(explanation_query_id, key)
         
         print("\n" + "=" * 60)
         if success:
@@ -144,9 +192,6 @@ def main():
     base_url = os.getenv("WREN_UI_URL", "http://wren-ui:3000")
     print(f"🌐 Using Wren-UI URL: {base_url}")
     
-    # Initialize tester
-    tester = WrenAITester(base_url)
-    
     # Test questions that should trigger NON_SQL_QUERY
     test_questions = [
         "Can you explain what the data in the amarnameh_MOH_MarketData_1403 table is about?",
@@ -156,22 +201,35 @@ def main():
         "Tell me about the data structure"
     ]
     
-    print(f"\n📋 Testing {len(test_questions)} questions...")
-    
-    success_count = 0
     total_tests = len(test_questions)
+    # Number of flows run at the same time (set to 1 for readable, serial output)
+    concurrency = max(1, int(os.getenv("WREN_TEST_CONCURRENCY", str(total_tests))))
     
-    for i, question in enumerate(test_questions, 1):
-        print(f"\n🔬 Test {i}/{total_tests}")
-        print("-" * 40)
-        
-        if tester.test_complete_flow(question):
-            success_count += 1
-        
-        # Add delay between tests
-        if i < total_tests:
-            print("\n⏳ Waiting 2 seconds before next test...")
-            time.sleep(2)
+    # Initialize tester (WREN_TEST_CACHE=<file> reuses explanations from earlier runs)
+    tester = WrenAITester(base_url, os.getenv("WREN_TEST_CACHE"), pool_size=max(16, concurrency))
+    
+    print(f"\n📋 Testing {total_tests} questions ({concurrency} at a time)...")
+    
+    # Each flow just waits on the network, so run them concurrently instead of
+    # serially with a fixed delay in between
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(tester.test_complete_flow, question) for question in test_questions]
+    
+    # A flow that raises counts as failed, so the others' results and the cache are kept
+    results = []
+    for question, future in zip(test_questions, futures):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            print(f"💥 Flow for '{question}' raised an error: {e}")
+            results.append(False)
+    
+    success_count = sum(results)
+    tester.save_cache()
+    
+    print("\n" + "=" * 60)
+    for i, (question, passed) in enumerate(zip(test_questions, results), 1):
+        print(f"{'✅' if passed else '❌'} Test {i}/{total_tests}: {question}")
     
     print("\n" + "=" * 60)
     print(f"📊 Test Results: {success_count}/{total_tests} tests passed")
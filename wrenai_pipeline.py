@@ -5,19 +5,204 @@ date: 2025-01-30
 version: 2.0
 license: MIT
 description: A pipeline for natural language to SQL query conversion using Wren-UI APIs with proper conversation context handling.
-requirements: requests, pydantic
+requirements: requests, pydantic, orjson
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 import logging
+import random
+import re
+import socket
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import chain
+from operator import itemgetter
 from typing import List, Union, Generator, Iterator
 import os
 from pydantic import BaseModel
 import json
-import uuid
+
+# orjson encodes/decodes several times faster than the stdlib, which is the fallback
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:
+    _loads = json.loads
+
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
 
 logging.basicConfig(level=logging.INFO)
 
+# Headers sent with every Wren-UI request
+_DEFAULT_HEADERS = {
+    "Accept": "application/json; charset=utf-8",
+    "Content-Type": "application/json; charset=utf-8",
+    "User-Agent": "WrenAI-Pipeline/2.0",
+    "Connection": "keep-alive"
+}
+
+# urllib3 already sets TCP_NODELAY; add TCP keep-alive so idle pooled connections
+# (and long-running queries) aren't silently dropped by NAT or load balancers
+_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+if hasattr(socket, "TCP_KEEPIDLE"):
+    _SOCKET_OPTIONS.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60))
+
+# Chats whose Wren-UI thread ID is remembered
+THREAD_IDS_MAX_ENTRIES = 10_000
+
+# Successful /ask responses are reused for repeated questions within this window
+ASK_CACHE_TTL = 300  # seconds
+ASK_CACHE_MAX_ENTRIES = 256
+# Query results go stale faster, so they get a shorter window
+SQL_CACHE_TTL = 60  # seconds
+SQL_CACHE_MAX_ENTRIES = 128
+
+# Largest piece yielded to Open WebUI; bigger chunks fail with "Chunk too big"
+STREAM_CHUNK_SIZE = 2000
+
+# Column formatters and header lines kept for recently seen result schemas
+SCHEMA_CACHE_MAX_ENTRIES = 32
+
+# Capped exponential retry backoff, plus random jitter so concurrent chats
+# don't all retry at the same instant
+RETRY_BASE_DELAY = 0.25  # seconds
+RETRY_BACKOFF_CAP = 8  # seconds
+RETRY_JITTER = 0.25  # seconds
+
+def _format_value(value) -> str:
+    """Format a table cell for better readability."""
+    if isinstance(value, float):
+        # Format large numbers with commas
+        if abs(value) >= 1000:
+            return f"{value:,.2f}"
+        return f"{value:.2f}"
+    if isinstance(value, int):
+        return f"{value:,}"
+    return str(value) if value is not None else ""
+
+# Bullet point and header prefixes that clean_text keeps as-is
+_LIST_ITEM_PREFIXES = ('- ', '* ', '#')
+
+# Lines that start a list item or header ("1." to "9.", bullets, headers)
+_LIST_RE = re.compile(r"[1-9]\.|[-*#]")
+
+# Fetches both fields of an Open WebUI message in one call
+_role_and_content = itemgetter('role', 'content')
+
+# Body of a previous answer's summary section, up to the next heading marker
+_SUMMARY_RE = re.compile(r"## 📊 Summary(.*?)(?=##|\Z)", re.DOTALL)
+
+# Declared-type formatters fall back to _format_value when a cell holds something
+# else (NULLs, mixed columns), so the output always matches the generic formatter
+def _format_int(value) -> str:
+    return f"{value:,}" if type(value) is int else _format_value(value)
+
+def _format_float(value) -> str:
+    if type(value) is float:
+        return f"{value:,.2f}" if abs(value) >= 1000 else f"{value:.2f}"
+    return _format_value(value)
+
+def _format_str(value) -> str:
+    return value if type(value) is str else _format_value(value)
+
+_COLUMN_FORMATTERS = {
+    "TINYINT": _format_int,
+    "SMALLINT": _format_int,
+    "INT": _format_int,
+    "INTEGER": _format_int,
+    "BIGINT": _format_int,
+    "FLOAT": _format_float,
+    "REAL": _format_float,
+    "DOUBLE": _format_float,
+    "CHAR": _format_str,
+    "VARCHAR": _format_str,
+    "TEXT": _format_str,
+    "STRING": _format_str,
+}
+
+# Formatters for columns whose declared type is unknown, picked from a sample value
+_SAMPLE_FORMATTERS = {int: _format_int, float: _format_float, str: _format_str}
+
+def _sampled_formatter(values: list):
+    """Pick a formatter for an untyped column from its first non-null value."""
+    for value in values:
+        if value is not None:
+            return _SAMPLE_FORMATTERS.get(type(value), _format_value)
+    return _format_value
+
+def _column_formatter(column: dict):
+    """Pick the cell formatter for a column from its declared type."""
+    column_type = (column.get("type") or "").split("(", 1)[0].strip().upper()
+    return _COLUMN_FORMATTERS.get(column_type, _format_value)
+
+def _backoff_delay(attempt: int) -> float:
+    """Seconds to wait before retrying after the given (0-based) attempt."""
+    return min(RETRY_BACKOFF_CAP, RETRY_BASE_DELAY * 2 ** attempt) + random.uniform(0, RETRY_JITTER)
+
+def _coalesce(pieces: Iterator[str], limit: int) -> Iterator[str]:
+    """Merge small pieces into blocks of at most limit characters."""
+    buffer = []
+    size = 0
+    for piece in pieces:
+        if not piece:
+            continue
+        if size + len(piece) > limit and buffer:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+        if len(piece) > limit:
+            # Only an unusually wide row needs splitting
+            for i in range(0, len(piece), limit):
+                yield piece[i:i + limit]
+            continue
+        buffer.append(piece)
+        size += len(piece)
+    if buffer:
+        yield "".join(buffer)
+
+@lru_cache(maxsize=256)
+def _clean_text(text: str) -> str:
+    """Convert API response text to markdown; cached since Wren-UI often repeats summaries and errors."""
+    # Replace escaped newlines, quotes and backslashes (in this order); most summaries have none
+    cleaned = text
+    if "\\" in cleaned:
+        cleaned = cleaned.replace('\\n', '\n').replace('\\"', '"').replace("\\'", "'").replace('\\\\', '\\')
+    
+    # Convert to proper markdown format
+    formatted_lines = []
+    append = formatted_lines.append
+    previous = ''
+    
+    for line in cleaned.split('\n'):
+        line = line.strip()
+        if not line:
+            append('')
+            previous = ''
+            continue
+        
+        # Numbered lists (1. Item), bullet points and headers are kept as-is
+        if not ((line[0].isdigit() and '. ' in line) or line.startswith(_LIST_ITEM_PREFIXES)):
+            # Add a blank line before new paragraphs
+            if previous and not _LIST_RE.match(previous):
+                append('')
+        append(line)
+        previous = line
+    
+    return '\n'.join(formatted_lines)
+
+class _KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter whose pooled sockets use _SOCKET_OPTIONS."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = _SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
 class Pipeline:
     class Valves(BaseModel):
         WREN_UI_URL: str
@@ -28,7 +213,16 @@ class Pipeline:
     def __init__(self):
         self.nlsql_response = ""
         # Thread ID management: store thread IDs per Open WebUI chat
-        self.thread_ids = {}  # {openwebui_chat_id: wren_ui_thread_id}
+        # Least recently used chats are forgotten once THREAD_IDS_MAX_ENTRIES is reached
+        self.thread_ids = OrderedDict()  # {openwebui_chat_id: wren_ui_thread_id}
+        # {(normalized_question, thread_id): (stored_at, ask_response)}, oldest first
+        self._ask_cache = OrderedDict()
+        # {(sql, thread_id): (stored_at, run_sql_response)}, oldest first
+        self._sql_cache = OrderedDict()
+        # {((column name, type), ...): (formatters, header, separator)}, oldest first
+        self._schema_cache = OrderedDict()
+        # pipe() runs in worker threads; guards the LRU bookkeeping of the dicts above
+        self._lock = threading.Lock()
 
         self.valves = self.Valves(
             **{
@@ -42,202 +236,219 @@ class Pipeline:
         
         # Set the name from the valve value
         self.name = self.valves.MODEL_NAME
+        self._build_urls()
 
-    @property
-    def name(self):
-        """Dynamic name property that updates when valves change."""
-        return self.valves.MODEL_NAME
-
-    @name.setter
-    def name(self, value):
-        """Setter for name property."""
-        self._name = value
+        # Persistent HTTP session: keeps the connection to Wren-UI alive between
+        # the ask -> run_sql pair and across user turns
+        self._session = requests.Session()
+        self._session.headers.update(_DEFAULT_HEADERS)
+        adapter = _KeepAliveAdapter(pool_connections=4, pool_maxsize=16, max_retries=0)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
 
     async def on_startup(self):
         """Initialize the pipeline on startup."""
         # Update name in case valves were changed after initialization
         self.name = self.valves.MODEL_NAME
-        logging.info(f"WrenAI Pipeline started with URL: {self.valves.WREN_UI_URL}")
-        logging.info(f"Pipeline name: {self.name}")
+        self._build_urls()
+        logging.info("WrenAI Pipeline started with URL: %s", self.valves.WREN_UI_URL)
+        logging.info("Pipeline name: %s", self.name)
 
     async def on_shutdown(self):
         """Cleanup on shutdown."""
+        self._session.close()
         logging.info("WrenAI Pipeline shutdown")
 
+    async def on_valves_updated(self):
+        """Pick up a renamed model or a new Wren-UI URL when the valves change."""
+        self.name = self.valves.MODEL_NAME
+        self._build_urls()
+
+    def _build_urls(self):
+        """Build the Wren-UI endpoint URLs from the current valves."""
+        base_url = self.valves.WREN_UI_URL.rstrip("/")
+        self._ask_url = f"{base_url}/api/v1/ask"
+        self._run_sql_url = f"{base_url}/api/v1/run_sql"
+
     def get_thread_id_for_chat(self, openwebui_chat_id: str) -> str:
         """Get the Wren-UI thread ID for a given Open WebUI chat ID."""
-        return self.thread_ids.get(openwebui_chat_id)
+        with self._lock:
+            thread_id = self.thread_ids.get(openwebui_chat_id)
+            if thread_id is not None:
+                self.thread_ids.move_to_end(openwebui_chat_id)
+        return thread_id
 
     def set_thread_id_for_chat(self, openwebui_chat_id: str, wren_ui_thread_id: str):
         """Set the Wren-UI thread ID for a given Open WebUI chat ID."""
-        self.thread_ids[openwebui_chat_id] = wren_ui_thread_id
-        logging.info(f"Stored thread ID {wren_ui_thread_id} for chat {openwebui_chat_id}")
+        with self._lock:
+            self.thread_ids[openwebui_chat_id] = wren_ui_thread_id
+            self.thread_ids.move_to_end(openwebui_chat_id)
+            while len(self.thread_ids) > THREAD_IDS_MAX_ENTRIES:
+                self.thread_ids.popitem(last=False)
+        logging.info("Stored thread ID %s for chat %s", wren_ui_thread_id, openwebui_chat_id)
 
     def is_new_chat(self, openwebui_chat_id: str) -> bool:
         """Check if this is a new chat (no stored thread ID)."""
         return openwebui_chat_id not in self.thread_ids
 
+    def _cache_get(self, cache: OrderedDict, key, ttl: float):
+        """Return a shallow copy of a fresh cached response, or None."""
+        with self._lock:
+            entry = cache.get(key)
+            if entry is None:
+                return None
+            stored_at, response = entry
+            if time.monotonic() - stored_at > ttl:
+                del cache[key]
+                return None
+            cache.move_to_end(key)
+        return dict(response)
+
+    def _cache_put(self, cache: OrderedDict, key, response: dict, max_entries: int):
+        """Store a response, evicting the least recently used entries."""
+        with self._lock:
+            cache[key] = (time.monotonic(), response)
+            cache.move_to_end(key)
+            while len(cache) > max_entries:
+                cache.popitem(last=False)
+
     def make_request_with_retry(self, url: str, method: str = "POST", data: dict = None, retries: int = 3, timeout: int = 600):
         """Make HTTP request with retry logic and extended timeout."""
-        headers = {
-            "Accept": "application/json; charset=utf-8",
-            "Content-Type": "application/json; charset=utf-8",
-            "User-Agent": "WrenAI-Pipeline/2.0",
-            "Connection": "keep-alive"
-        }
+        # Serialize the payload once rather than on every attempt; the JSON
+        # Content-Type header is already set on the session
+        body = None if data is None else _dumps(data)
+        is_post = method.upper() == "POST"
         
         for attempt in range(retries):
             try:
-                logging.info(f"Request attempt {attempt + 1}/{retries} to {url} with timeout {timeout}s")
+                logging.info("Request attempt %d/%d to %s with timeout %ss", attempt + 1, retries, url, timeout)
                 
-                if method.upper() == "POST":
+                if is_post:
                     # Use tuple for timeout: (connect timeout, read timeout)
-                    response = requests.post(url, json=data, headers=headers, timeout=(30, timeout))
+                    response = self._session.post(url, data=body, timeout=(30, timeout))
                 else:
-                    response = requests.get(url, headers=headers, timeout=(30, timeout))
+                    response = self._session.get(url, timeout=(30, timeout))
                 
-                logging.info(f"Response status: {response.status_code}")
+                logging.info("Response status: %s", response.status_code)
                 
                 # Handle 400 responses that contain JSON error messages
                 if response.status_code == 400:
                     try:
-                        error_data = response.json()
-                        logging.warning(f"400 Bad Request: {error_data}")
-                        return error_data  # Return the error data instead of raising
-                    except:
+                        error_data = _loads(response.content)
+                    except ValueError:
                         response.raise_for_status()
+                    else:
+                        logging.warning("400 Bad Request: %s", error_data)
+                        return error_data  # Return the error data instead of raising
                 else:
                     response.raise_for_status()
                 
-                return response.json()
+                return _loads(response.content)
                 
             except requests.exceptions.Timeout as e:
-                logging.error(f"Timeout on attempt {attempt + 1}/{retries}: {e}")
+                logging.error("Timeout on attempt %d/%d: %s", attempt + 1, retries, e)
                 if attempt + 1 == retries:
                     return {
                         "error": f"Request timed out after {timeout} seconds. The database query is taking too long. Please try a simpler query or contact your administrator.",
                         "code": "TIMEOUT_ERROR"
                     }
-                import time
-                time.sleep(5)  # Wait 5 seconds before retry
+                time.sleep(_backoff_delay(attempt))
                 
             except requests.exceptions.ConnectionError as e:
-                logging.error(f"Connection error on attempt {attempt + 1}/{retries}: {e}")
+                logging.error("Connection error on attempt %d/%d: %s", attempt + 1, retries, e)
                 if attempt + 1 == retries:
                     return {
                         "error": f"Connection error: {str(e)}. Please check if Wren-UI is running and accessible.",
                         "code": "CONNECTION_ERROR"
                     }
-                import time
-                time.sleep(5)
+                time.sleep(_backoff_delay(attempt))
                 
             except requests.exceptions.RequestException as e:
-                logging.error(f"Request failed on attempt {attempt + 1}/{retries}: {e}")
+                logging.error("Request failed on attempt %d/%d: %s", attempt + 1, retries, e)
                 if attempt + 1 == retries:
                     return {
                         "error": f"Request failed: {str(e)}",
                         "code": "REQUEST_ERROR"
                     }
-                import time
-                time.sleep(2 ** attempt)  # Exponential backoff
+                time.sleep(_backoff_delay(attempt))
 
-    def create_markdown_table(self, records: List[dict], columns: List[dict], max_rows: int = 500) -> str:
-        """Create a markdown table from SQL query results."""
-        if not records or not columns:
-            return "No data available."
+    def _table_schema(self, columns: List[dict]) -> tuple:
+        """Return the per-column formatters and header lines, cached by schema."""
+        schema_key = tuple((col["name"], col.get("type")) for col in columns)
+        with self._lock:
+            schema = self._schema_cache.get(schema_key)
+            if schema is not None:
+                self._schema_cache.move_to_end(schema_key)
+                return schema
         
-        # Limit rows to max_rows
-        limited_records = records[:max_rows]
-        
-        # Get column names
         column_names = [col["name"] for col in columns]
+        schema = (
+            [(col["name"], _column_formatter(col)) for col in columns],
+            "| " + " | ".join(column_names) + " |\n",
+            "| " + " | ".join(["---"] * len(column_names)) + " |\n",
+        )
+        with self._lock:
+            self._schema_cache[schema_key] = schema
+            while len(self._schema_cache) > SCHEMA_CACHE_MAX_ENTRIES:
+                self._schema_cache.popitem(last=False)
+        return schema
+
+    def iter_markdown_table(self, records: List[dict], columns: List[dict], max_rows: int = 500, total_rows: int = None) -> Iterator[str]:
+        """Yield a markdown table of SQL query results one line at a time.
         
-        # Create table header
-        header = "| " + " | ".join(column_names) + " |"
-        separator = "| " + " | ".join(["---"] * len(column_names)) + " |"
+        total_rows is the row count reported by Wren-UI, when known; the summary
+        falls back to the number of records received.
+        """
+        if not records or not columns:
+            yield "No data available."
+            return
         
-        # Create table rows
-        rows = []
-        for record in limited_records:
-            row_values = []
-            for col_name in column_names:
-                value = record.get(col_name, "")
-                # Format the value for better readability
-                if isinstance(value, (int, float)):
-                    if isinstance(value, float):
-                        # Format large numbers with commas
-                        if abs(value) >= 1000:
-                            formatted_value = f"{value:,.2f}"
-                        else:
-                            formatted_value = f"{value:.2f}"
-                    else:
-                        formatted_value = f"{value:,}"
-                else:
-                    formatted_value = str(value) if value is not None else ""
-                
-                row_values.append(formatted_value)
-            
-            row = "| " + " | ".join(row_values) + " |"
-            rows.append(row)
+        # Limit rows to max_rows; the common case fits and needs no copy
+        limited_records = records if len(records) <= max_rows else records[:max_rows]
         
-        # Combine header, separator, and rows
-        table_lines = [header, separator] + rows
+        formatters, header, separator = self._table_schema(columns)
+        
+        # Table header and separator
+        yield header
+        yield separator
+        
+        # Format column by column so each formatter runs in its own tight loop,
+        # then zip the columns back into rows
+        column_values = []
+        for col_name, fmt in formatters:
+            try:
+                # itemgetter pulls the whole column in one C-level loop
+                values = list(map(itemgetter(col_name), limited_records))
+            except KeyError:
+                values = [record.get(col_name, "") for record in limited_records]
+            if fmt is _format_value:
+                fmt = _sampled_formatter(values)
+            if fmt is _format_str:
+                # Text columns are nearly all str already: skip the call per cell
+                column_values.append([v if type(v) is str else _format_value(v) for v in values])
+            else:
+                column_values.append(list(map(fmt, values)))
+        for row_values in zip(*column_values):
+            yield "| " + " | ".join(row_values) + " |\n"
         
         # Add summary
-        total_rows = len(records)
+        total_rows = max(total_rows or 0, len(records))
         displayed_rows = len(limited_records)
         
-        summary = f"\n**Total rows:** {total_rows:,}"
+        summary = f"**Total rows:** {total_rows:,}"
         if displayed_rows < total_rows:
             summary += f" (showing first {displayed_rows:,} rows)"
-        
-        return "\n".join(table_lines) + summary
+        yield summary
+
+    def create_markdown_table(self, records: List[dict], columns: List[dict], max_rows: int = 500, total_rows: int = None) -> str:
+        """Create a markdown table from SQL query results."""
+        return "".join(self.iter_markdown_table(records, columns, max_rows, total_rows))
 
     def clean_text(self, text: str) -> str:
         """Convert API response text to proper markdown format for Open WebUI rendering."""
         if not text:
             return text
-        
-        # Replace escaped newlines with actual newlines
-        cleaned = text.replace('\\n', '\n')
-        
-        # Replace escaped quotes
-        cleaned = cleaned.replace('\\"', '"')
-        cleaned = cleaned.replace("\\'", "'")
-        
-        # Replace escaped backslashes
-        cleaned = cleaned.replace('\\\\', '\\')
-        
-        # Convert to proper markdown format
-        lines = cleaned.split('\n')
-        formatted_lines = []
-        
-        for i, line in enumerate(lines):
-            line = line.strip()
-            if not line:
-                formatted_lines.append('')
-                continue
-                
-            # Handle numbered lists (1. Item, 2. Item, etc.)
-            if line[0].isdigit() and '. ' in line:
-                # Ensure proper markdown list formatting
-                formatted_lines.append(line)
-            # Handle bullet points or other list items
-            elif line.startswith('- ') or line.startswith('* '):
-                formatted_lines.append(line)
-            # Handle headers (if any)
-            elif line.startswith('#'):
-                formatted_lines.append(line)
-            # Handle regular paragraphs
-            else:
-                # Add proper spacing for paragraphs
-                if formatted_lines and formatted_lines[-1] and not formatted_lines[-1].startswith(('1.', '2.', '3.', '4.', '5.', '6.', '7.', '8.', '9.', '-', '*', '#')):
-                    # Add a blank line before new paragraphs
-                    if not formatted_lines[-1].startswith('\n'):
-                        formatted_lines.append('')
-                formatted_lines.append(line)
-        
-        return '\n'.join(formatted_lines)
+        return _clean_text(text)
 
     def extract_conversation_context(self, messages: List[dict]) -> str:
         """Extract conversation context from Open WebUI messages for better follow-up handling."""
@@ -249,53 +460,47 @@ class Pipeline:
         context_parts = []
         
         for msg in context_messages:
-            role = msg.get('role', '')
-            content = msg.get('content', '')
+            try:
+                role, content = _role_and_content(msg)
+            except KeyError:
+                role = msg.get('role', '')
+                content = msg.get('content', '')
             
             if role == 'user':
                 context_parts.append(f"User: {content}")
             elif role == 'assistant':
                 # Extract key information from assistant responses
-                if 'SQL Query' in content:
-                    # Extract SQL from previous responses
-                    lines = content.split('\n')
+                fence = content.find('```sql') if 'SQL Query' in content else -1
+                if fence != -1:
+                    # Extract SQL from previous responses, starting at the first
+                    # ```sql line; replies without a fence skip the line scan
                     sql_lines = []
-                    in_sql = False
-                    for line in lines:
+                    for line in content[fence:].split('\n')[1:]:
                         if '```sql' in line:
-                            in_sql = True
                             continue
-                        elif '```' in line and in_sql:
-                            in_sql = False
+                        elif '```' in line:
                             break
-                        elif in_sql:
-                            sql_lines.append(line)
+                        sql_lines.append(line)
                     
                     if sql_lines:
                         context_parts.append(f"Previous SQL: {' '.join(sql_lines)}")
                 
                 # Extract summary information
-                if 'Summary' in content:
-                    summary_start = content.find('## 📊 Summary')
-                    if summary_start != -1:
-                        summary_end = content.find('##', summary_start + 1)
-                        if summary_end == -1:
-                            summary_end = len(content)
-                        summary = content[summary_start:summary_end].replace('## 📊 Summary', '').strip()
-                        if summary:
-                            context_parts.append(f"Previous Summary: {summary[:200]}...")
+                match = _SUMMARY_RE.search(content)
+                if match:
+                    summary = match.group(1).strip()
+                    if summary:
+                        context_parts.append(f"Previous Summary: {summary[:200]}...")
         
         return "\n".join(context_parts)
 
     def ask_question_with_context(self, question: str, conversation_context: str = "", thread_id: str = None) -> dict:
         """Ask a question to Wren-UI API with conversation context."""
-        ask_url = f"{self.valves.WREN_UI_URL}/api/v1/ask"
-        
         # Enhance question with context if available
         enhanced_question = question
         if conversation_context:
             enhanced_question = f"{question}\n\nContext from previous conversation:\n{conversation_context}"
-            logging.info(f"Enhanced question with context: {enhanced_question[:200]}...")
+            logging.info("Enhanced question with context: %.200s...", enhanced_question)
         
         payload = {
             "question": enhanced_question
@@ -304,13 +509,21 @@ class Pipeline:
         # Add thread ID for follow-up questions
         if thread_id:
             payload["threadId"] = thread_id
-            logging.info(f"Using thread ID: {thread_id}")
+            logging.info("Using thread ID: %s", thread_id)
 
-        logging.info(f"Asking question: {question}")
+        logging.info("Asking question: %s", question)
+        
+        # Only follow-ups in an existing thread are cached: a new chat's /ask creates
+        # its own Wren thread, and a cached response would hand it another chat's threadId
+        cache_key = (" ".join(enhanced_question.lower().split()), thread_id) if thread_id else None
+        cached = self._cache_get(self._ask_cache, cache_key, ASK_CACHE_TTL) if cache_key else None
+        if cached is not None:
+            logging.info("Ask response served from cache: %s", cached.get("id", "unknown"))
+            return cached
         
         try:
             response = self.make_request_with_retry(
-                ask_url, 
+                self._ask_url, 
                 method="POST", 
                 data=payload, 
                 timeout=self.valves.WREN_UI_TIMEOUT
@@ -318,13 +531,15 @@ class Pipeline:
             
             # Check if the response contains an error
             if response.get("error") or response.get("code") == "NO_RELEVANT_DATA":
-                logging.warning(f"Wren-UI returned error: {response.get('error', 'Unknown error')}")
+                logging.warning("Wren-UI returned error: %s", response.get("error", "Unknown error"))
                 return response  # Return the error response as-is
             
-            logging.info(f"Ask response received: {response.get('id', 'unknown')}")
+            logging.info("Ask response received: %s", response.get("id", "unknown"))
+            if cache_key:
+                self._cache_put(self._ask_cache, cache_key, response, ASK_CACHE_MAX_ENTRIES)
             return response
         except Exception as e:
-            logging.error(f"Error asking question: {e}")
+            logging.error("Error asking question: %s", e)
             return {
                 "id": "error",
                 "error": f"Failed to ask question: {str(e)}"
@@ -332,27 +547,35 @@ class Pipeline:
 
     def run_sql(self, sql: str, thread_id: str = None) -> dict:
         """Execute SQL query using Wren-UI API."""
-        run_sql_url = f"{self.valves.WREN_UI_URL}/api/v1/run_sql"
-        
         payload = {
             "sql": sql
         }
         if thread_id:
             payload["threadId"] = thread_id
 
-        logging.info(f"Running SQL: {sql[:100]}...")
+        logging.info("Running SQL: %.100s...", sql)
+        
+        # Only surrounding whitespace is normalized: case and inner spacing can
+        # matter inside string literals
+        cache_key = (sql.strip(), thread_id)
+        cached = self._cache_get(self._sql_cache, cache_key, SQL_CACHE_TTL)
+        if cached is not None:
+            logging.info("SQL result served from cache, %d records", len(cached.get("records", [])))
+            return cached
         
         try:
             response = self.make_request_with_retry(
-                run_sql_url, 
+                self._run_sql_url, 
                 method="POST", 
                 data=payload, 
                 timeout=self.valves.WREN_UI_TIMEOUT
             )
-            logging.info(f"SQL execution successful, got {len(response.get('records', []))} records")
+            logging.info("SQL execution successful, got %d records", len(response.get("records", [])))
+            if not response.get("error"):
+                self._cache_put(self._sql_cache, cache_key, response, SQL_CACHE_MAX_ENTRIES)
             return response
         except Exception as e:
-            logging.error(f"Error executing SQL: {e}")
+            logging.error("Error executing SQL: %s", e)
             return {
                 "error": f"Failed to execute SQL: {str(e)}",
                 "records": [],
@@ -377,14 +600,14 @@ class Pipeline:
             wren_ui_thread_id = self.get_thread_id_for_chat(openwebui_chat_id)
             
             if wren_ui_thread_id:
-                logging.info(f"Using existing Wren-UI thread ID: {wren_ui_thread_id} for chat: {openwebui_chat_id}")
+                logging.info("Using existing Wren-UI thread ID: %s for chat: %s", wren_ui_thread_id, openwebui_chat_id)
             else:
-                logging.info(f"New chat detected: {openwebui_chat_id}, will get thread ID from Wren-UI response")
+                logging.info("New chat detected: %s, will get thread ID from Wren-UI response", openwebui_chat_id)
             
             # Extract conversation context for better follow-up handling
             conversation_context = self.extract_conversation_context(messages)
             if conversation_context:
-                logging.info(f"Extracted conversation context: {conversation_context[:200]}...")
+                logging.info("Extracted conversation context: %.200s...", conversation_context)
             
             # Step 1: Ask the question to get SQL query and summary
             logging.info("Step 1: Asking question to Wren-UI...")
@@ -394,7 +617,7 @@ class Pipeline:
             if not wren_ui_thread_id and ask_response.get("threadId"):
                 self.set_thread_id_for_chat(openwebui_chat_id, ask_response["threadId"])
                 wren_ui_thread_id = ask_response["threadId"]
-                logging.info(f"Stored new Wren-UI thread ID: {wren_ui_thread_id} for chat: {openwebui_chat_id}")
+                logging.info("Stored new Wren-UI thread ID: %s for chat: %s", wren_ui_thread_id, openwebui_chat_id)
             
             # Check for errors in the response
             if ask_response.get("error") or ask_response.get("code") == "NO_RELEVANT_DATA":
@@ -403,15 +626,18 @@ class Pipeline:
                 return
             
             # Stream response content
-            # Add summary if available
+            # Summary and SQL are both known now, so they go out together
+            # before run_sql starts
+            sections = []
             if ask_response.get("summary"):
                 # Clean up the summary text formatting
                 clean_summary = self.clean_text(ask_response['summary'])
-                yield f"## 📊 Summary\n\n{clean_summary}\n\n"
+                sections.append(f"## 📊 Summary\n\n{clean_summary}\n\n")
             
             # Add SQL query if present
             if ask_response.get("sql"):
-                yield f"## 🔍 SQL Query\n\n```sql\n{ask_response['sql']}\n```\n\n"
+                sections.append(f"## 🔍 SQL Query\n\n```sql\n{ask_response['sql']}\n```\n\n")
+                yield from _coalesce(sections, STREAM_CHUNK_SIZE)
                 
                 # Step 2: Execute the SQL query
                 logging.info("Step 2: Executing SQL query...")
@@ -425,20 +651,23 @@ class Pipeline:
                     total_rows = sql_response.get("totalRows", 0)
                     
                     if records and columns:
-                        yield f"## 📋 Results ({total_rows:,} rows)\n\n"
-                        # Create the table and stream it in small chunks to avoid "Chunk too big" error
-                        table_content = self.create_markdown_table(records, columns, self.valves.MAX_ROWS)
-                        # Split table into smaller chunks for streaming
-                        chunk_size = 2000  # Smaller chunks to prevent "Chunk too big" error
-                        for i in range(0, len(table_content), chunk_size):
-                            yield table_content[i:i + chunk_size]
+                        # Stream the heading and table in blocks of whole lines, each
+                        # small enough to avoid the "Chunk too big" error
+                        yield from _coalesce(
+                            chain(
+                                [f"## 📋 Results ({total_rows:,} rows)\n\n"],
+                                self.iter_markdown_table(records, columns, self.valves.MAX_ROWS, total_rows),
+                            ),
+                            STREAM_CHUNK_SIZE,
+                        )
                     else:
                         yield "## 📋 Results\n\n*No data returned from the query.*"
             else:
-                yield "## ⚠️ No SQL Query Generated\n\n*The question could not be converted to a SQL query.*"
+                sections.append("## ⚠️ No SQL Query Generated\n\n*The question could not be converted to a SQL query.*")
+                yield from _coalesce(sections, STREAM_CHUNK_SIZE)
             
             logging.info("Pipeline completed successfully")
             
         except Exception as e:
-            logging.error(f"Pipeline execution error: {e}")
+            logging.error("Pipeline execution error: %s", e)
             yield f"**Pipeline Error:** {str(e)}"
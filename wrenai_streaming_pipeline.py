@@ -5,15 +5,208 @@ date: 2025-10-04
 version: 4.4
 license: MIT
 description: Calls /stream/ask exactly once for real user questions. Ignores Open-WebUI synthetic prompts (follow-ups, auto-title, etc.). Chart generation kept as your working version (Vega Editor link + PNG/SVG HTML).
-requirements: requests, pydantic
+requirements: requests, pydantic, orjson
 """
 
-import os, json, logging, requests
-from typing import List, Union, Generator, Iterator, Optional, Dict
+import os, re, json, logging, threading, requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from operator import itemgetter
+from types import MappingProxyType
+from typing import List, Union, Generator, Iterator, Optional, Dict, Tuple
 from pydantic import BaseModel
 
+# orjson encodes/decodes several times faster than the stdlib, which is the fallback
+try:
+    import orjson
+    _loads = orjson.loads
+
+    def _dumps(obj, indent: bool = False) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None).decode("utf-8")
+except ImportError:
+    _loads = json.loads
+
+    def _dumps(obj, indent: bool = False) -> str:
+        # Compact like orjson, so spliced JSON (see build_vega_editor_url) matches either way
+        if indent:
+            return json.dumps(obj, ensure_ascii=False, indent=2)
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
 logging.basicConfig(level=logging.INFO)
 
+# Open-WebUI rejects larger streamed chunks ("Chunk too big")
+STREAM_CHUNK_SIZE = 2000
+# Table rows sent per streamed chunk
+TABLE_BATCH_ROWS = 32
+# SSE field prefix for event payloads, matched against raw bytes
+_DATA_PREFIX = b"data:"
+# Shared read-only stand-in for a missing object in an SSE event
+_EMPTY = MappingProxyType({})
+# Default number of chats remembered per state map before the least recently used is dropped
+CHAT_STATE_MAX_ENTRIES = 10_000
+# Generated charts kept for repeat "Show chart" on the same result
+CHART_CACHE_MAX_ENTRIES = 128
+
+
+def _fmt_cell(v) -> str:
+    if isinstance(v, float):
+        return f"{v:,.2f}" if abs(v) >= 1000 else f"{v:.2f}"
+    if isinstance(v, int):
+        return f"{v:,}"
+    return "" if v is None else str(v)
+
+# Per-column fast paths; a cell of any other type goes through _fmt_cell
+def _fmt_int(v) -> str:
+    return f"{v:,}" if type(v) is int else _fmt_cell(v)
+
+def _fmt_float(v) -> str:
+    if type(v) is float:
+        return f"{v:,.2f}" if abs(v) >= 1000 else f"{v:.2f}"
+    return _fmt_cell(v)
+
+def _fmt_str(v) -> str:
+    return v if type(v) is str else _fmt_cell(v)
+
+_TYPE_FORMATTERS = {
+    "TINYINT": _fmt_int, "SMALLINT": _fmt_int, "INT": _fmt_int, "INTEGER": _fmt_int, "BIGINT": _fmt_int,
+    "FLOAT": _fmt_float, "REAL": _fmt_float, "DOUBLE": _fmt_float,
+    "CHAR": _fmt_str, "VARCHAR": _fmt_str, "TEXT": _fmt_str, "STRING": _fmt_str,
+}
+_SAMPLE_FORMATTERS = {int: _fmt_int, float: _fmt_float, str: _fmt_str}
+
+
+def _pick_formatter(column: dict, sample):
+    """Cell formatter for a column: its declared type if known, else the type of a sample value."""
+    col_type = (column.get("type") or "").split("(", 1)[0].strip().upper()
+    fmt = _TYPE_FORMATTERS.get(col_type)
+    if fmt is None:
+        fmt = _SAMPLE_FORMATTERS.get(type(sample), _fmt_cell)
+    return fmt
+
+
+def _coalesce(pieces: Iterator[str], limit: int) -> Iterator[str]:
+    """Merge small pieces into blocks of at most limit characters."""
+    buffer = []
+    size = 0
+    for piece in pieces:
+        if not piece:
+            continue
+        if size + len(piece) > limit and buffer:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+        if len(piece) > limit:
+            # Only an unusually long piece needs splitting
+            for i in range(0, len(piece), limit):
+                yield piece[i:i + limit]
+            continue
+        buffer.append(piece)
+        size += len(piece)
+    if buffer:
+        yield "".join(buffer)
+
+
+class _LRUDict(OrderedDict):
+    """Dict bounded to the `maxsize` most recently used keys; safe to share between pipe() threads."""
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self:
+                return default
+            self.move_to_end(key)
+            return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+            self.move_to_end(key)
+            if len(self) > self.maxsize:
+                self.popitem(last=False)
+
+    def resize(self, maxsize: int):
+        """Change the bound, dropping the least recently used keys past it."""
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self) > maxsize:
+                self.popitem(last=False)
+
+@lru_cache(maxsize=32)
+def _header_for(names: Tuple[str, ...]) -> str:
+    """Markdown header and separator rows; result sets usually repeat the same columns."""
+    return "| " + " | ".join(names) + " |\n| " + " | ".join(["---"] * len(names)) + " |\n"
+
+
+
+# Standalone chart page, split around the two values that change per chart
+_HTML_PREFIX = """<!doctype html>
+<html>
+<head>
+  <meta charset="utf-8"/>
+  <title>"""
+_HTML_SPEC_PREFIX = """</title>
+  <meta name="viewport" content="width=device-width, initial-scale=1"/>
+  <script src="https://cdn.jsdelivr.net/npm/vega@5"></script>
+  <script src="https://cdn.jsdelivr.net/npm/vega-lite@5"></script>
+  <script src="https://cdn.jsdelivr.net/npm/vega-embed@6"></script>
+  <style>
+    body { font-family: system-ui, -apple-system, Segoe UI, Roboto, sans-serif; margin:0; padding:16px; background:#f9fafb; }
+    .container { max-width: 1200px; margin: 0 auto; background: white; padding: 24px; border-radius: 12px; box-shadow: 0 1px 3px rgba(0,0,0,0.1); }
+    .bar { display:flex; gap:12px; flex-wrap:wrap; align-items:center; margin-bottom:20px; }
+    .bar a { text-decoration:none; padding:10px 16px; border-radius:8px; border:1px solid #d0d7de; background:#f6f8fa; font-size:14px; font-weight:500; transition:all 0.2s; }
+    .bar a:hover { background:#1570EF; color:white; border-color:#1570EF; }
+    #vis { width:100%; height:500px; margin-top:16px; }
+    .hint { color:#6b7280; font-size:12px; margin-top:12px; font-style:italic; }
+    .error { color:#b91c1c; background:#fee; padding:16px; border-radius:8px; border:1px solid #fcc; }
+  </style>
+</head>
+<body>
+  <div class="container">
+    <div class="bar">
+      <a href="#" id="savePNG">🖼️ Save as PNG</a>
+      <a href="#" id="saveSVG">📄 Save as SVG</a>
+    </div>
+    <div id="vis"></div>
+    <div class="hint">Tip: Hover over elements to see values. Click action buttons above to export.</div>
+  </div>
+
+  <script type="text/javascript">
+    const spec = """
+_HTML_SUFFIX = """;
+    vegaEmbed('#vis', spec, { actions: false, renderer: 'canvas' }).then(result => {
+      const view = result.view;
+      document.getElementById('savePNG').addEventListener('click', e => {
+        e.preventDefault();
+        view.toImageURL('png').then(url => {
+          const a = document.createElement('a'); a.href = url; a.download = 'chart.png';
+          document.body.appendChild(a); a.click(); document.body.removeChild(a);
+        }).catch(err => alert('PNG export failed: ' + err.message));
+      });
+      document.getElementById('saveSVG').addEventListener('click', e => {
+        e.preventDefault();
+        view.toSVG().then(svg => {
+          const blob = new Blob([svg], { type: 'image/svg+xml' });
+          const url = URL.createObjectURL(blob);
+          const a = document.createElement('a'); a.href = url; a.download = 'chart.svg';
+          document.body.appendChild(a); a.click(); document.body.removeChild(a); URL.revokeObjectURL(url);
+        }).catch(err => alert('SVG export failed: ' + err.message));
+      });
+    }).catch(err => {
+      document.getElementById('vis').innerHTML = '<div class="error"><strong>Error loading chart:</strong><br>' + err + '</div>';
+      console.error('Vega-Embed Error:', err);
+    });
+  </script>
+</body>
+</html>"""
+
 
 class Pipeline:
     class Valves(BaseModel):
@@ -21,13 +214,10 @@ class Pipeline:
         WREN_UI_TIMEOUT: int = 600
         MAX_ROWS: int = 500
         MODEL_NAME: str = "WrenAI Database Query (Streaming)"
+        CHAT_CACHE_SIZE: int = CHAT_STATE_MAX_ENTRIES
+        RUN_SQL_WORKERS: int = 4
 
     def __init__(self):
-        # session-scoped state (per Open-WebUI chat)
-        self.thread_ids: Dict[str, str] = {}        # { chat_id: wren_thread_id }
-        self.last_sql: Dict[str, str] = {}          # { chat_id: last_success_sql }
-        self.last_question: Dict[str, str] = {}     # { chat_id: last_effective_question }
-
         self.valves = self.Valves(
             **{
                 "pipelines": ["*"],
@@ -35,23 +225,86 @@ class Pipeline:
                 "WREN_UI_TIMEOUT": int(os.getenv("WREN_UI_TIMEOUT", "600")),
                 "MAX_ROWS": int(os.getenv("MAX_ROWS", "500")),
                 "MODEL_NAME": os.getenv("MODEL_NAME", "WrenAI Database Query (Streaming)"),
+                "CHAT_CACHE_SIZE": int(os.getenv("CHAT_CACHE_SIZE", str(CHAT_STATE_MAX_ENTRIES))),
+                "RUN_SQL_WORKERS": int(os.getenv("RUN_SQL_WORKERS", "4")),
             }
         )
-        self._name = self.valves.MODEL_NAME
 
-    # ---------------- Lifecycle ----------------
-    @property
-    def name(self): return self.valves.MODEL_NAME
-    @name.setter
-    def name(self, value): self._name = value
+        # session-scoped state (per Open-WebUI chat), bounded so a long-running server doesn't grow forever
+        self.thread_ids: Dict[str, str] = _LRUDict(self.valves.CHAT_CACHE_SIZE)     # { chat_id: wren_thread_id }
+        self.last_sql: Dict[str, str] = _LRUDict(self.valves.CHAT_CACHE_SIZE)       # { chat_id: last_success_sql }
+        self.last_question: Dict[str, str] = _LRUDict(self.valves.CHAT_CACHE_SIZE)  # { chat_id: last_effective_question }
+        self._chart_cache: Dict[tuple, dict] = _LRUDict(CHART_CACHE_MAX_ENTRIES)  # { (question, sql, thread_id): chart }
+        self.name = self.valves.MODEL_NAME
+
+        # LZ-compressing the spec is the slow part of a Vega Editor link; repeated
+        # "Show chart" on the same spec reuses the link
+        self._editor_url_for_payload = lru_cache(maxsize=64)(self._editor_url_from_payload)
+
+        # Request headers never change, so build them once (read-only, shared by every call)
+        self._base_headers = MappingProxyType({
+            "Accept": "application/json; charset=utf-8",
+            "Content-Type": "application/json; charset=utf-8",
+            "User-Agent": "WrenAI-OpenWebUI-Pipeline/4.4",
+            "Connection": "keep-alive",
+        })
+        self._sse_headers = MappingProxyType({**self._base_headers, "Accept": "text/event-stream"})
+
+        # One pooled keep-alive session, so run_sql and chart calls reuse the /stream/ask socket
+        self._session = requests.Session()
+        self._session.headers.update(self._base_headers)
+        # Only failed connects are retried (nothing reached the server yet). Every call is a POST,
+        # and /ask and /run_sql aren't safe to resend after a read error or a 5xx
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=20,
+            max_retries=Retry(total=2, read=0, backoff_factor=0.2),
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        # Runs /run_sql as soon as the SQL is generated, while the answer text is still streaming
+        self._start_executor()
 
+    # ---------------- Lifecycle ----------------
     async def on_startup(self):
         self.name = self.valves.MODEL_NAME
         logging.info(f"WrenAI Pipeline started. Base URL: {self.valves.WREN_UI_URL}")
 
     async def on_shutdown(self):
+        self._executor.shutdown(wait=False)
+        self._session.close()
         logging.info("WrenAI Pipeline down")
 
+    async def on_valves_updated(self):
+        self.name = self.valves.MODEL_NAME
+        for state in (self.thread_ids, self.last_sql, self.last_question):
+            state.resize(self.valves.CHAT_CACHE_SIZE)
+        if self._executor_workers != max(1, self.valves.RUN_SQL_WORKERS):
+            # Queries already running on the old pool finish there; new ones use the new size
+            self._executor.shutdown(wait=False)
+            self._start_executor()
+
+    # ---------------- Early /run_sql ----------------
+    def _start_executor(self):
+        self._executor_workers = max(1, self.valves.RUN_SQL_WORKERS)
+        self._executor = ThreadPoolExecutor(max_workers=self._executor_workers, thread_name_prefix="wren-run-sql")
+        # One slot per worker: an early query never queues behind other chats' queries
+        self._prefetch_slots = threading.BoundedSemaphore(self._executor_workers)
+
+    def _prefetch_run_sql(self, sql: str, thread_id: Optional[str]) -> Optional[Future]:
+        """Start /run_sql in the background, or return None if every worker is busy."""
+        slots = self._prefetch_slots
+        if not slots.acquire(blocking=False):
+            return None
+        try:
+            fut = self._executor.submit(self._run_sql, sql, thread_id)
+        except RuntimeError:  # pool shut down by a valve update in between
+            slots.release()
+            return None
+        fut.add_done_callback(lambda _f: slots.release())
+        return fut
+
     # ---------------- Thread helpers ----------------
     def get_thread_id_for_chat(self, chat_id: str) -> Optional[str]:
         return self.thread_ids.get(chat_id)
@@ -61,93 +314,134 @@ class Pipeline:
         logging.info(f"Stored thread ID {thread_id} for chat {chat_id}")
 
     # ---------------- HTTP helpers ----------------
-    def _headers(self):
-        return {
-            "Accept": "application/json; charset=utf-8",
-            "Content-Type": "application/json; charset=utf-8",
-            "User-Agent": "WrenAI-OpenWebUI-Pipeline/4.4",
-            "Connection": "keep-alive",
-        }
-
     def _post_json(self, path: str, payload: dict, timeout: Optional[int] = None):
         url = f"{self.valves.WREN_UI_URL}{path}"
-        r = requests.post(url, json=payload, headers=self._headers(), timeout=(30, timeout or self.valves.WREN_UI_TIMEOUT))
+        r = self._session.post(url, json=payload, timeout=(30, timeout or self.valves.WREN_UI_TIMEOUT))
+        # Parse the raw body bytes directly (orjson when available) instead of r.json()
         if r.status_code >= 400:
             try:
-                return r.json()
+                return _loads(r.content)
             except Exception:
                 r.raise_for_status()
-        return r.json()
+        return _loads(r.content)
 
     def _post_sse(self, path: str, payload: dict):
         """Single streaming call site. Force UTF-8 decoding to avoid mojibake."""
         url = f"{self.valves.WREN_UI_URL}{path}"
-        with requests.post(
+        with self._session.post(
             url,
             json=payload,
-            headers={**self._headers(), "Accept": "text/event-stream"},
+            headers=self._sse_headers,
             stream=True,
             timeout=(30, self.valves.WREN_UI_TIMEOUT),
         ) as r:
             r.raise_for_status()
             # Do NOT rely on r.encoding (often ISO-8859-1 for SSE). Decode bytes as UTF-8 ourselves.
-            for raw in r.iter_lines(decode_unicode=False):  # bytes, not str
-                if not raw:
-                    continue
-                if raw.startswith(b"data:"):
-                    data_bytes = raw[len(b"data:"):].strip()
-                    if not data_bytes:
-                        continue
-                    try:
-                        data_text = data_bytes.decode("utf-8", errors="strict")
-                    except UnicodeDecodeError:
-                        # Fallback: replace undecodable bytes instead of crashing
-                        data_text = data_bytes.decode("utf-8", errors="replace")
-                    try:
-                        yield json.loads(data_text)
-                    except Exception:
-                        # Non-JSON payload (rare); still return as text
-                        yield {"type": "raw", "data": data_text}
+            # Lines are split in a byte buffer; a partial line waits for the next chunk.
+            # An event's data: lines are collected and parsed once, at the blank line ending it.
+            buf = bytearray()
+            data_lines: List[bytes] = []
+            for chunk in r.iter_content(chunk_size=8192, decode_unicode=False):
+                buf.extend(chunk)
+                start = 0
+                while (nl := buf.find(b"\n", start)) != -1:
+                    line = bytes(buf[start:nl]).rstrip(b"\r")
+                    start = nl + 1
+                    if not line:
+                        if data_lines:
+                            yield from self._parse_sse_data(b"\n".join(data_lines))
+                            data_lines = []
+                    elif line.startswith(_DATA_PREFIX):
+                        data_lines.append(line[len(_DATA_PREFIX):])
+                del buf[:start]
+            # Stream ended without a final blank line
+            if buf.startswith(_DATA_PREFIX):
+                data_lines.append(bytes(buf[len(_DATA_PREFIX):]).rstrip(b"\r"))
+            if data_lines:
+                yield from self._parse_sse_data(b"\n".join(data_lines))
+
+    @staticmethod
+    def _parse_sse_data(payload: bytes):
+        """One event's data payload (multi-line data: fields already joined) as a dict."""
+        data_bytes = payload.strip()
+        if not data_bytes:
+            return
+        try:
+            # Both parsers take UTF-8 bytes directly
+            evt = _loads(data_bytes)
+        except Exception:
+            # Fallback: replace undecodable bytes instead of crashing
+            data_text = data_bytes.decode("utf-8", errors="replace")
+            try:
+                evt = _loads(data_text)
+            except Exception:
+                # Non-JSON payload (rare); still return as text
+                evt = {"type": "raw", "data": data_text}
+        yield evt
 
 
     # ---------------- Formatting helpers ----------------
     def _md_table(self, records: List[dict], columns: List[dict], max_rows: int) -> str:
+        return "".join(self._md_table_stream(records, columns, max_rows))
+
+    def _md_table_stream(self, records: List[dict], columns: List[dict], max_rows: int) -> Iterator[str]:
+        """Markdown table as header, batches of rows, then footer; every piece fits in one stream chunk."""
         if not records or not columns:
-            return "No data available."
+            yield "No data available."
+            return
         names = [c["name"] for c in columns]
-        head = "| " + " | ".join(names) + " |\n| " + " | ".join(["---"] * len(names)) + " |\n"
-        lines = []
-        for rec in records[:max_rows]:
-            vals = []
-            for n in names:
-                v = rec.get(n, "")
-                if isinstance(v, float):
-                    vals.append(f"{v:,.2f}" if abs(v) >= 1000 else f"{v:.2f}")
-                elif isinstance(v, int):
-                    vals.append(f"{v:,}")
-                else:
-                    vals.append("" if v is None else str(v))
-            lines.append("| " + " | ".join(vals) + " |")
-        extra = (
-            f"\n\n**Total rows:** {len(records):,} (showing first {max_rows:,})"
-            if len(records) > max_rows
-            else f"\n\n**Total rows:** {len(records):,}"
-        )
-        return head + "\n".join(lines) + extra
+        yield from self._chunked(_header_for(tuple(names)))
+        first = records[0]
+        fmts = [_pick_formatter(c, first.get(n)) for c, n in zip(columns, names)]
+        # One C-level call pulls a row's cells; a row missing a column falls back to .get
+        get_cells = itemgetter(*names)
+        single = len(names) == 1
+        total = len(records)
+        # Wren-UI usually returns no more than MAX_ROWS, so the whole list is shown as-is
+        if total <= max_rows:
+            rows, shown = records, ""
+        else:
+            rows, shown = islice(records, max_rows), f" (showing first {max_rows:,})"
+        batch, size, sep = [], 0, ""
+        for rec in rows:
+            try:
+                vals = (get_cells(rec),) if single else get_cells(rec)
+            except KeyError:
+                vals = [rec.get(n, "") for n in names]
+            # One f-string builds the row in a single allocation instead of two concatenations
+            row = f"| {' | '.join([fmt(v) for fmt, v in zip(fmts, vals)])} |"
+            if batch and (len(batch) == TABLE_BATCH_ROWS or size + len(row) + 1 > STREAM_CHUNK_SIZE):
+                yield from self._chunked(sep + "\n".join(batch))
+                batch, size, sep = [], 0, "\n"
+            batch.append(row)
+            size += len(row) + 1
+        if batch:
+            yield from self._chunked(sep + "\n".join(batch))
+        yield f"\n\n**Total rows:** {total:,}{shown}"
+
+    @staticmethod
+    def _chunked(text: str) -> Iterator[str]:
+        # Only an unusually wide header or row needs splitting
+        if len(text) <= STREAM_CHUNK_SIZE:
+            yield text
+            return
+        for i in range(0, len(text), STREAM_CHUNK_SIZE):
+            yield text[i:i + STREAM_CHUNK_SIZE]
+
+    # Escapes undone by _clean, in a single left-to-right pass
+    _CLEAN_RE = re.compile(r"\\([n\"'\\])")
+    _CLEAN_MAP = {"n": "\n", '"': '"', "'": "'", "\\": "\\"}
 
     def _clean(self, s: Optional[str]) -> str:
         if not s:
             return ""
-        return (
-            s.replace("\\n", "\n")
-             .replace('\\"', '"')
-             .replace("\\'", "'")
-             .replace('\\\\', '\\')
-        )
+        return self._CLEAN_RE.sub(lambda m: self._CLEAN_MAP[m.group(1)], s)
 
     # ---------------- Vega (working block) ----------------
     _base64_uri = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+-$"
-    def _lz_char_from_int(self, a: int) -> str: return self._base64_uri[a]
+    _base64_uri_bytes = _base64_uri.encode("ascii")  # output chars as single bytes
+    # Output char for a 6-bit group collected LSB first (the stream's first bit is a char's top bit)
+    _base64_uri_lsb = bytes(map(_base64_uri_bytes.__getitem__, (int(f"{i:06b}"[::-1], 2) for i in range(64))))
 
     def _lz_compress_to_uri_component(self, uncompressed: str) -> str:
         """Minimal Python adaptation of LZ-String compressToEncodedURIComponent."""
@@ -155,15 +449,11 @@ class Pipeline:
         dict_map, dict_to_create = {}, {}
         wc = ""
         enlarge_in, dict_size, num_bits = 2, 3, 2
-        data, data_val, data_position = [], 0, 0
-        def write_bits(value, numbits):
-            nonlocal data_val, data_position, data
-            for _ in range(numbits):
-                data_val = (data_val << 1) | (value & 1); value >>= 1
-                if data_position == 5:
-                    data.append(self._lz_char_from_int(data_val)); data_val = 0; data_position = 0
-                else:
-                    data_position += 1
+        # LZ-String writes every value LSB first, so bits are stacked onto the top of
+        # `acc` as they come and whole 6-bit groups are taken off the bottom.
+        # All state is local; the bit writes are inlined below.
+        data, acc, acc_bits = bytearray(), 0, 0
+        append, uri_lsb = data.append, self._base64_uri_lsb
         for cc in uncompressed:
             if cc not in dict_map:
                 dict_map[cc] = dict_size; dict_size += 1; dict_to_create[cc] = True
@@ -172,97 +462,51 @@ class Pipeline:
                 wc = wc2
             else:
                 if wc in dict_to_create:
-                    if ord(wc[0]) < 256: write_bits(0, num_bits); write_bits(ord(wc[0]), 8)
-                    else: write_bits(1, num_bits); write_bits(ord(wc[0]), 16)
-                    enlarge_in -= 1
-                    if enlarge_in == 0: enlarge_in, num_bits = 2 ** num_bits, num_bits + 1
+                    # Literal: flag 0 + 8-bit char, or flag 1 + 16-bit char
+                    c = ord(wc[0])
+                    if c < 256: acc |= (c << num_bits) << acc_bits; acc_bits += num_bits + 8
+                    else: acc |= (1 | (c & 0xFFFF) << num_bits) << acc_bits; acc_bits += num_bits + 16
                     del dict_to_create[wc]
                 else:
-                    write_bits(dict_map[wc], num_bits); enlarge_in -= 1
-                    if enlarge_in == 0: enlarge_in, num_bits = 2 ** num_bits, num_bits + 1
+                    acc |= (dict_map[wc] & ((1 << num_bits) - 1)) << acc_bits; acc_bits += num_bits
+                enlarge_in -= 1
+                if enlarge_in == 0: enlarge_in, num_bits = 2 ** num_bits, num_bits + 1
+                while acc_bits >= 6:
+                    append(uri_lsb[acc & 0x3F]); acc >>= 6; acc_bits -= 6
                 dict_map[wc2] = dict_size; dict_size += 1; wc = cc
         if wc:
             if wc in dict_to_create:
-                if ord(wc[0]) < 256: write_bits(0, num_bits); write_bits(ord(wc[0]), 8)
-                else: write_bits(1, num_bits); write_bits(ord(wc[0]), 16)
+                c = ord(wc[0])
+                if c < 256: acc |= (c << num_bits) << acc_bits; acc_bits += num_bits + 8
+                else: acc |= (1 | (c & 0xFFFF) << num_bits) << acc_bits; acc_bits += num_bits + 16
                 del dict_to_create[wc]
             else:
-                write_bits(dict_map[wc], num_bits)
+                acc |= (dict_map[wc] & ((1 << num_bits) - 1)) << acc_bits; acc_bits += num_bits
             enlarge_in -= 1
             if enlarge_in == 0: enlarge_in, num_bits = 2 ** num_bits, num_bits + 1
-        write_bits(2, num_bits)
-        while True:
-            data_val <<= 1
-            if data_position == 5:
-                data.append(self._lz_char_from_int(data_val)); break
-            else:
-                data_position += 1
-        return "".join(data)
-
-    def build_vega_editor_url(self, vega_spec: dict, mode: str = "vega-lite") -> str:
-        payload = {"mode": mode, "spec": vega_spec}
-        encoded = self._lz_compress_to_uri_component(json.dumps(payload, ensure_ascii=False))
+        # End-of-stream marker
+        acc |= 2 << acc_bits; acc_bits += num_bits
+        while acc_bits >= 6:
+            append(uri_lsb[acc & 0x3F]); acc >>= 6; acc_bits -= 6
+        # Zero-pad to the end of the current character (a whole extra one if aligned)
+        append(uri_lsb[acc])
+        return data.decode("ascii")
+
+    def build_vega_editor_url(self, vega_spec: dict, mode: str = "vega-lite", spec_json: Optional[str] = None) -> str:
+        """Pass `spec_json` (compact _dumps of the spec) when the caller already has it."""
+        if spec_json is None:
+            spec_json = _dumps(vega_spec)
+        # Same text as _dumps({"mode": mode, "spec": vega_spec}), without walking the spec again.
+        # The serialized payload is both the cache key and the text to compress.
+        return self._editor_url_for_payload(f'{{"mode":{_dumps(mode)},"spec":{spec_json}}}')
+
+    def _editor_url_from_payload(self, payload_json: str) -> str:
+        encoded = self._lz_compress_to_uri_component(payload_json)
         return f"https://vega.github.io/editor/#/url/vega-lite/{encoded}"
 
     def build_standalone_html(self, vega_spec: dict, title: str = "Vega-Lite Chart") -> str:
-        spec_json = json.dumps(vega_spec, ensure_ascii=False, indent=2)
-        return f"""<!doctype html>
-<html>
-<head>
-  <meta charset="utf-8"/>
-  <title>{title}</title>
-  <meta name="viewport" content="width=device-width, initial-scale=1"/>
-  <script src="https://cdn.jsdelivr.net/npm/vega@5"></script>
-  <script src="https://cdn.jsdelivr.net/npm/vega-lite@5"></script>
-  <script src="https://cdn.jsdelivr.net/npm/vega-embed@6"></script>
-  <style>
-    body {{ font-family: system-ui, -apple-system, Segoe UI, Roboto, sans-serif; margin:0; padding:16px; background:#f9fafb; }}
-    .container {{ max-width: 1200px; margin: 0 auto; background: white; padding: 24px; border-radius: 12px; box-shadow: 0 1px 3px rgba(0,0,0,0.1); }}
-    .bar {{ display:flex; gap:12px; flex-wrap:wrap; align-items:center; margin-bottom:20px; }}
-    .bar a {{ text-decoration:none; padding:10px 16px; border-radius:8px; border:1px solid #d0d7de; background:#f6f8fa; font-size:14px; font-weight:500; transition:all 0.2s; }}
-    .bar a:hover {{ background:#1570EF; color:white; border-color:#1570EF; }}
-    #vis {{ width:100%; height:500px; margin-top:16px; }}
-    .hint {{ color:#6b7280; font-size:12px; margin-top:12px; font-style:italic; }}
-    .error {{ color:#b91c1c; background:#fee; padding:16px; border-radius:8px; border:1px solid #fcc; }}
-  </style>
-</head>
-<body>
-  <div class="container">
-    <div class="bar">
-      <a href="#" id="savePNG">🖼️ Save as PNG</a>
-      <a href="#" id="saveSVG">📄 Save as SVG</a>
-    </div>
-    <div id="vis"></div>
-    <div class="hint">Tip: Hover over elements to see values. Click action buttons above to export.</div>
-  </div>
-
-  <script type="text/javascript">
-    const spec = {spec_json};
-    vegaEmbed('#vis', spec, {{ actions: false, renderer: 'canvas' }}).then(result => {{
-      const view = result.view;
-      document.getElementById('savePNG').addEventListener('click', e => {{
-        e.preventDefault();
-        view.toImageURL('png').then(url => {{
-          const a = document.createElement('a'); a.href = url; a.download = 'chart.png';
-          document.body.appendChild(a); a.click(); document.body.removeChild(a);
-        }}).catch(err => alert('PNG export failed: ' + err.message));
-      }});
-      document.getElementById('saveSVG').addEventListener('click', e => {{
-        e.preventDefault();
-        view.toSVG().then(svg => {{
-          const blob = new Blob([svg], {{ type: 'image/svg+xml' }});
-          const url = URL.createObjectURL(blob);
-          const a = document.createElement('a'); a.href = url; a.download = 'chart.svg';
-          document.body.appendChild(a); a.click(); document.body.removeChild(a); URL.revokeObjectURL(url);
-        }}).catch(err => alert('SVG export failed: ' + err.message));
-      }});
-    }}).catch(err => {{
-      document.getElementById('vis').innerHTML = '<div class="error"><strong>Error loading chart:</strong><br>' + err + '</div>';
-      console.error('Vega-Embed Error:', err);
-    }});
-  </script>
-</body>
-</html>"""
+        spec_json = _dumps(vega_spec, indent=True)
+        return "".join((_HTML_PREFIX, title, _HTML_SPEC_PREFIX, spec_json, _HTML_SUFFIX))
 
     # ---------------- Wren endpoints ----------------
     def _run_sql(self, sql: str, thread_id: Optional[str]):
@@ -271,7 +515,7 @@ class Pipeline:
             payload["threadId"] = thread_id
         return self._post_json("/api/v1/run_sql", payload)
 
-    def _generate_chart(self, question: str, sql: str, thread_id: Optional[str]):
+    def _generate_chart(self, question: str, sql: str, thread_id: Optional[str], no_cache: bool = False):
         # working behavior you had (question + sql [+ threadId])
         if not question or not question.strip():
             raise ValueError("Question is required for chart generation")
@@ -280,13 +524,50 @@ class Pipeline:
         payload = {"question": question.strip(), "sql": sql.strip()}
         if thread_id:
             payload["threadId"] = thread_id
-        return self._post_json("/api/v1/generate_vega_chart", payload)
+        # The chart only depends on these inputs; skip the LLM call when they repeat
+        # (no_cache asks for a fresh chart, which then replaces the cached one)
+        key = (payload["question"], payload["sql"], thread_id)
+        chart = None if no_cache else self._chart_cache.get(key)
+        if chart is None:
+            chart = self._post_json("/api/v1/generate_vega_chart", payload)
+            # Only successful charts are cached, so a failure is retried next time
+            if "error" not in chart and chart.get("vegaSpec"):
+                self._chart_cache[key] = chart
+        return chart
 
     # ---------------- Command & auto-prompt detection ----------------
     def _is_chart_cmd(self, txt: str) -> bool:
         t = (txt or "").strip().lower()
         return t in {"show chart", "chart", "/chart"}
 
+    # Markers that on their own identify an Open-WebUI synthetic prompt
+    _AUTOPROMPT_RE = re.compile("|".join(map(re.escape, (
+        # Generic markers present in OWUI synthetic prompts
+        "chat_history",
+        "### task:",
+        "output: json",
+        "your entire response must consist solely of a json object",
+        # Follow-ups generator templates
+        "follow-up",
+        "follow ups",
+        '"follow_ups"',
+        # Auto-title generator templates
+        "generate a concise, 3-5 word title",
+    ))), re.IGNORECASE)
+
+    # Templates recognised by several markers together; every one of them mentions the chat history
+    _CHAT_HISTORY_RE = re.compile(r"chat history", re.IGNORECASE)
+    _AUTOPROMPT_COMBOS = tuple(
+        tuple(re.compile(re.escape(marker), re.IGNORECASE) for marker in combo)
+        for combo in (
+            # Auto-title generator templates
+            ("emoji summarizing the chat history", "title"),
+            ('"title":', "examples:"),
+            # Any other system-like prompts that reference /stream/ask with history
+            ("/stream/ask",),
+        )
+    )
+
     def _is_openwebui_autoprompt(self, txt: str) -> bool:
         """
         Detects Open-WebUI synthetic prompts (follow-ups, auto-title, etc.).
@@ -294,33 +575,12 @@ class Pipeline:
         """
         if not txt:
             return False
-        low = txt.lower()
-
-        # Generic markers present in OWUI synthetic prompts
-        if "chat_history" in low or "<chat_history>" in low or "</chat_history>" in low:
-            return True
-        if "### task:" in low or "output: json" in low or "your entire response must consist solely of a json object" in low:
-            return True
-
-        # Follow-ups generator templates
-        if "follow-up" in low or "follow ups" in low or '"follow_ups"' in low:
-            return True
-        if "suggest 3-5 relevant follow-up questions" in low:
-            return True
-
-        # Auto-title generator templates
-        if "generate a concise, 3-5 word title" in low:
-            return True
-        if "emoji summarizing the chat history" in low and "title" in low:
-            return True
-        if '"title":' in low and "examples:" in low and "chat history" in low:
-            return True
-
-        # Any other system-like prompts that reference /stream/ask with history
-        if "/stream/ask" in low and "chat history" in low:
+        # IGNORECASE matching instead of a lowercased copy of a possibly large prompt
+        if self._AUTOPROMPT_RE.search(txt):
             return True
-
-        return False
+        if not self._CHAT_HISTORY_RE.search(txt):
+            return False
+        return any(all(p.search(txt) for p in combo) for combo in self._AUTOPROMPT_COMBOS)
     
     def _normalize_stream_text(self, s: Optional[str]) -> str:
         """
@@ -358,19 +618,20 @@ class Pipeline:
         • After sql_execution_end, pulls rows once via /run_sql.
         • Chart generation on demand via "Show chart".
         """
-        metadata = (body or {}).get("metadata", {})
-        chat_id = metadata.get("chat_id") or metadata.get("session_id") or metadata.get("thread_id") or "unknown-chat"
-        thread_id = self.get_thread_id_for_chat(chat_id)
-
         # ONLY the direct user message; never read `messages` history
         question = (user_message or "").strip()
         if not question:
             return "Please enter a question."
 
-        # Ignore Open-WebUI auto-prompts (prevents the duplicate /stream/ask you see in logs)
+        # Ignore Open-WebUI auto-prompts (prevents the duplicate /stream/ask you see in logs).
+        # Checked before any chat lookups, since these fire on most turns.
         if self._is_openwebui_autoprompt(question):
             return ""
 
+        metadata = (body or {}).get("metadata", {})
+        chat_id = metadata.get("chat_id") or metadata.get("session_id") or metadata.get("thread_id") or "unknown-chat"
+        thread_id = self.get_thread_id_for_chat(chat_id)
+
         # Chart command
         if self._is_chart_cmd(question):
             last_sql = self.last_sql.get(chat_id)
@@ -379,35 +640,39 @@ class Pipeline:
                 return ("⚠️ **No SQL query found in this chat yet.**\n\nAsk a data question first, then send **Show chart**.")
             if not last_q:
                 return ("⚠️ **No question found in this chat yet.**\n\nAsk a data question first, then send **Show chart**.")
+            no_cache = bool((body or {}).get("no_cache"))
 
             def _chart():
                 yield "### 📈 Generating chart…\n"
                 try:
-                    chart = self._generate_chart(last_q, last_sql, thread_id)
+                    chart = self._generate_chart(last_q, last_sql, thread_id, no_cache=no_cache)
                     if "error" in chart:
                         yield f"❌ **Chart generation failed** `{chart.get('code','UNKNOWN')}`\n\n{chart.get('error','Unknown error')}\n"
                         return
                     spec = chart.get("vegaSpec")
                     if not spec:
                         yield f"❌ Unexpected chart response: {chart}\n"; return
+                    out = []
                     # 1) Raw spec
-                    yield "```json\n" + json.dumps(spec, ensure_ascii=False) + "\n```\n"
+                    spec_json = _dumps(spec)
+                    out.append("```json\n" + spec_json + "\n```\n")
                     # 2) Vega Editor link
                     try:
-                        editor_url = self.build_vega_editor_url(spec, mode="vega-lite")
-                        yield f"[Open in Vega Editor]({editor_url})\n"
+                        editor_url = self.build_vega_editor_url(spec, mode="vega-lite", spec_json=spec_json)
+                        out.append(f"[Open in Vega Editor]({editor_url})\n")
                     except Exception as e:
-                        yield f"_Could not build Vega Editor link: {e}_\n"
+                        out.append(f"_Could not build Vega Editor link: {e}_\n")
                     # 3) Standalone HTML viewer
                     try:
                         html = self.build_standalone_html(spec, title="WrenAI Chart")
-                        yield "\n<details><summary>Standalone HTML viewer (click to expand)</summary>\n\n"
-                        yield "```html\n" + html + "\n```\n"
-                        yield "</details>\n"
-                        yield "_Save the HTML block above as `chart.html` and open it in a browser for an interactive chart._\n"
+                        out.append("\n<details><summary>Standalone HTML viewer (click to expand)</summary>\n\n")
+                        out.append("```html\n" + html + "\n```\n")
+                        out.append("</details>\n")
+                        out.append("_Save the HTML block above as `chart.html` and open it in a browser for an interactive chart._\n")
                     except Exception as e:
-                        yield f"_Could not build standalone HTML: {e}_\n"
-                    yield "_Tip: the Vega Editor link opens the chart already filled — no copy/paste needed._"
+                        out.append(f"_Could not build standalone HTML: {e}_\n")
+                    out.append("_Tip: the Vega Editor link opens the chart already filled — no copy/paste needed._")
+                    yield from _coalesce(out, STREAM_CHUNK_SIZE)
                 except Exception as e:
                     yield f"❌ **Chart generation exception:** {e}\n"
             return _chart()
@@ -419,99 +684,121 @@ class Pipeline:
 
             final_sql: Optional[str] = None
             saw_sql_exec_end = False
+            # (sql, thread_id, future) of the /run_sql started early
+            prefetch: Optional[Tuple[str, Optional[str], Future]] = None
             effective_question = question
 
-            payload = {"question": question}  # question only; no history
-            if thread_id:
-                payload["threadId"] = thread_id
-
             try:
-                for evt in self._post_sse("/api/v1/stream/ask", payload):
-                    et = evt.get("type")
-
-                    if et == "message_start":
-                        yield "- message_start\n"
-
-                    elif et == "state":
-                        data = evt.get("data", {})
-                        state = data.get("state")
-                        if state:
-                            yield f"- {state}\n"
-
-                        if data.get("threadId") and not thread_id:
-                            thread_id = data["threadId"]
-                            self.set_thread_id_for_chat(chat_id, thread_id)
-
-                        if data.get("rephrasedQuestion"):
-                            effective_question = data["rephrasedQuestion"]
-                            yield f"  - rephrased: {effective_question}\n"
-                        if data.get("retrievedTables"):
-                            yield f"  - tables: {', '.join(data['retrievedTables'])}\n"
-                        if state == "sql_generation_success" and data.get("sql"):
-                            final_sql = data["sql"]
-                            yield "\n### 🔍 SQL Query (generated)\n"
-                            yield f"```sql\n{final_sql}\n```\n"
-                        if state == "sql_execution_end":
-                            saw_sql_exec_end = True
-
-                    elif et == "content_block_start":
-                        cb = evt.get("content_block", {})
-                        if cb.get("type") == "text":
-                            name = cb.get("name") or "content"
-                            # blank line before heading to break out of '- ...' list
-                            yield f"\n\n### 🧾 {name.replace('_',' ').title()}\n\n"
-
-                    elif et == "content_block_delta":
-                        delta = evt.get("delta", {})
-                        text = delta.get("text") or delta.get("value") or ""
-                        if text:
-                            yield self._normalize_stream_text(text)
-
-                    elif et == "content_block_stop":
-                        yield "\n"
-
-                    elif et == "error":
-                        data = evt.get("data", {})
-                        code = data.get("code", "UNKNOWN")
-                        msg = data.get("error", "Unknown error")
-                        yield f"\n❌ Error `{code}`: {msg}\n"
-                        return
+                payload = {"question": question}  # question only; no history
+                if thread_id:
+                    payload["threadId"] = thread_id
 
-                    elif et == "message_stop":
-                        data = evt.get("data", {})
-                        if data.get("threadId") and not thread_id:
-                            thread_id = data["threadId"]
-                            self.set_thread_id_for_chat(chat_id, thread_id)
-                        yield "- message_stop\n"
-
-            except requests.HTTPError as e:
-                yield f"\n❌ Streaming failed: {e}\n"
-                return
-
-            # Persist for charting
-            self.last_question[chat_id] = (effective_question or question or "").strip()
-
-            if final_sql and saw_sql_exec_end:
-                self.last_sql[chat_id] = final_sql
-                yield "\n### 📋 Results\n"
-                run = self._run_sql(final_sql, thread_id)
-                if run.get("error"):
-                    yield f"❌ SQL execution error: {run['error']}\n"
+                try:
+                    for evt in self._post_sse("/api/v1/stream/ask", payload):
+                        et = evt.get("type")
+                        data = evt.get("data") or _EMPTY
+                        # Everything one event produces goes out as a single chunk
+                        out = []
+
+                        if et == "message_start":
+                            out.append("- message_start\n")
+
+                        elif et == "state":
+                            state = data.get("state")
+                            if state:
+                                out.append(f"- {state}\n")
+
+                            if not thread_id and (new_thread_id := data.get("threadId")):
+                                thread_id = new_thread_id
+                                self.set_thread_id_for_chat(chat_id, thread_id)
+
+                            if rephrased := data.get("rephrasedQuestion"):
+                                effective_question = rephrased
+                                out.append(f"  - rephrased: {effective_question}\n")
+                            if tables := data.get("retrievedTables"):
+                                out.append(f"  - tables: {', '.join(tables)}\n")
+                            if state == "sql_generation_success" and (sql := data.get("sql")):
+                                final_sql = sql
+                                if prefetch is not None:
+                                    prefetch[2].cancel()
+                                # Without a thread yet, the final /run_sql may go out under a different
+                                # threadId, so only start early when the result can be reused
+                                fut = self._prefetch_run_sql(final_sql, thread_id) if thread_id else None
+                                prefetch = (final_sql, thread_id, fut) if fut is not None else None
+                                out.append("\n### 🔍 SQL Query (generated)\n")
+                                out.append(f"```sql\n{final_sql}\n```\n")
+                            if state == "sql_execution_end":
+                                saw_sql_exec_end = True
+
+                        elif et == "content_block_start":
+                            cb = evt.get("content_block") or _EMPTY
+                            if cb.get("type") == "text":
+                                name = cb.get("name") or "content"
+                                # blank line before heading to break out of '- ...' list
+                                out.append(f"\n\n### 🧾 {name.replace('_',' ').title()}\n\n")
+
+                        elif et == "content_block_delta":
+                            delta = evt.get("delta") or _EMPTY
+                            text = delta.get("text") or delta.get("value") or ""
+                            if text:
+                                out.append(self._normalize_stream_text(text))
+
+                        elif et == "content_block_stop":
+                            out.append("\n")
+
+                        elif et == "error":
+                            code = data.get("code", "UNKNOWN")
+                            msg = data.get("error", "Unknown error")
+                            out.append(f"\n❌ Error `{code}`: {msg}\n")
+                            yield from _coalesce(out, STREAM_CHUNK_SIZE)
+                            return
+
+                        elif et == "message_stop":
+                            if not thread_id and (new_thread_id := data.get("threadId")):
+                                thread_id = new_thread_id
+                                self.set_thread_id_for_chat(chat_id, thread_id)
+                            out.append("- message_stop\n")
+
+                        yield from _coalesce(out, STREAM_CHUNK_SIZE)
+
+                except requests.HTTPError as e:
+                    yield f"\n❌ Streaming failed: {e}\n"
+                    return
+
+                # Persist for charting
+                self.last_question[chat_id] = (effective_question or question or "").strip()
+
+                if final_sql and saw_sql_exec_end:
+                    self.last_sql[chat_id] = final_sql
+                    # Heading goes out on its own so it shows while /run_sql runs
+                    yield "\n### 📋 Results\n"
+                    yield from _coalesce(self._results(final_sql, thread_id, prefetch), STREAM_CHUNK_SIZE)
                 else:
-                    records = run.get("records", [])
-                    cols = run.get("columns", [])
-                    if records:
-                        table_md = self._md_table(records, cols, self.valves.MAX_ROWS)
-                        chunk = 2000
-                        for i in range(0, len(table_md), chunk):
-                            yield table_md[i:i+chunk]
-                    else:
-                        yield "_No data returned._\n"
-
-                yield "\n---\n"
-                yield "➡️ **Type `Show chart`** to render a Vega-Lite chart for this result.\n"
-            else:
-                yield "\n---\n"
-                yield "ℹ️ No SQL was produced for this question. Ask a data-related question to get tables and charts.\n"
+                    yield "\n---\nℹ️ No SQL was produced for this question. Ask a data-related question to get tables and charts.\n"
+            finally:
+                # An early /run_sql nobody reads (error, no results section, client gone) must not keep a worker
+                if prefetch is not None:
+                    prefetch[2].cancel()
 
         return _stream()
+
+    def _results(self, sql: str, thread_id: Optional[str], prefetch=None) -> Iterator[str]:
+        """Results section for the final SQL: table (or error) and the chart hint."""
+        # Reuse the early /run_sql only if it ran this exact query in this thread
+        # (a future that hasn't started yet is cancelled and run here instead of waiting in the queue)
+        if prefetch is not None and prefetch[:2] == (sql, thread_id) and not prefetch[2].cancel():
+            run = prefetch[2].result()
+        else:
+            run = self._run_sql(sql, thread_id)
+        if run.get("error"):
+            yield f"❌ SQL execution error: {run['error']}\n"
+        else:
+            records = run.get("records", [])
+            cols = run.get("columns", [])
+            if records:
+                yield from self._md_table_stream(records, cols, self.valves.MAX_ROWS)
+            else:
+                yield "_No data returned._\n"
+
+        yield "\n---\n"
+        yield "➡️ **Type `Show chart`** to render a Vega-Lite chart for this result.\n"